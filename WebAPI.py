@@ -1,11 +1,14 @@
 import os
 import time
-import json
+import orjson
 import random
+import threading
 from datetime import date
 import google.generativeai as genai
-from flask import Flask, jsonify
+from flask import Flask
 from dotenv import load_dotenv
+from cachetools import LRUCache
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 # --- 初期設定：道具や設計図を読み込む ---
@@ -13,6 +16,23 @@ load_dotenv()  # .envファイルから秘伝のレシピを読み込む
 app = Flask(__name__)  # Flaskという基本設計でアプリを作る
 CORS(app)  # 他の場所からの注文を許可する
 
+
+# --- JSONの変換は標準のjsonより高速なorjsonに任せる ---
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = OrjsonProvider(app)  # ルートからdictを返した場合もorjsonで変換される
+
+
+def json_response(data):
+    # jsonifyを経由せず、orjsonで直接レスポンスを組み立てる
+    return app.response_class(orjson.dumps(data), mimetype='application/json')
+
 # --- Gemini APIのセットアップ ---
 # このtry...exceptブロックの中に、お探しの行が含まれています。
 try:
@@ -33,86 +53,103 @@ except Exception as e:
 # レートリミット設定
 MINUTE_LIMIT = 55
 MINUTE_WINDOW = 60
-request_timestamps = []
+_now = time.monotonic  # 時刻合わせの影響を受けない単調増加クロック（属性参照も省く）
+# トークンバケット方式：残りトークン数と最終補充時刻の2つだけを保持する
+rate_tokens = float(MINUTE_LIMIT)
+rate_last_refill = _now()
 
 # API呼び出し上限設定
 DAILY_API_LIMIT = 500
 api_call_count = 0
-last_reset_date = date.today()
+last_reset_ord = date.today().toordinal()  # 比較を整数で済ませるため日付は序数で持つ
 
 # キャッシュとセットの設定
-QUIZ_CACHE = []
-SERVING_POOL = []
 SET_SIZE = 5
+# {問題文: クイズ}。同じ問題の重複登録を防ぐ
+# 補充はSET_SIZE品までだが、AIへの発注が同時に複数走ると超えることがあるため、上限を超えた分は最も長く使われていないものから捨てる
+QUIZ_CACHE = LRUCache(maxsize=SET_SIZE)
+QUIZ_KEYS = ()  # 提供時にランダムに選ぶための問題文の一覧。登録時にだけ作り直す
+
+# 上記のグローバル変数（レートリミット・発注回数・キャッシュ）をまとめて守るロック
+_STATE_LOCK = threading.Lock()
+
+# AIへの注文文（リクエストごとに作り直さないよう、モジュール読み込み時に1回だけ用意する）
+_QUIZ_PROMPT = "日本の歴史に関する面白い二択クイズを1問、JSON形式で{\"question\": \"問題文\", \"options\": [\"選択肢A\", \"選択肢B\"], \"answer\": \"正解の選択肢\"} の形式で生成してください。"
+
+# AIにはJSONだけを返させる（応答から"{"〜"}"を探す必要がなくなる）
+QUIZ_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "OBJECT",
+        "properties": {
+            "question": {"type": "STRING"},
+            "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "answer": {"type": "STRING"},
+        },
+        "required": ["question", "options", "answer"],
+    },
+}
 
 
 # --- 「/quiz」という注文が来た時の対応マニュアル ---
 @app.route('/quiz', methods=['GET'])
 def generate_quiz():
-    global QUIZ_CACHE, SERVING_POOL, api_call_count, last_reset_date, request_timestamps
-
-    # --- ルール1：1分あたりのリクエスト数制限チェック ---
-    current_time = time.time()
-    request_timestamps = [t for t in request_timestamps if current_time - t < MINUTE_WINDOW]
-    if len(request_timestamps) >= MINUTE_LIMIT:
-        print(f">>> [レートリミット] 1分あたりのリクエスト上限({MINUTE_LIMIT}回)に達しました。")
-        return jsonify({"error": f"Rate limit of {MINUTE_LIMIT} requests per minute exceeded."}), 429
-    request_timestamps.append(current_time)
-
-    # --- コース料理とビュッフェのロジック ---
-    if SERVING_POOL:
-        print(f">>> [コース提供] 配膳トレイから提供します。(残り {len(SERVING_POOL) - 1} 品)")
-        quiz = SERVING_POOL.pop()
-        return jsonify(quiz)
-
-    print("--- 配膳トレイが空です。次の準備をします。 ---")
-
-    today = date.today()
-    if today > last_reset_date:
-        api_call_count = 0
-        last_reset_date = today
-        print(f">>> [システム] 新しい日です。API発注回数をリセットしました。")
-
-    if len(QUIZ_CACHE) < SET_SIZE and api_call_count < DAILY_API_LIMIT:
-        print(f">>> [ビュッフェ補充] 品数不足のため、新しいクイズを調理します。")
-        try:
-            api_call_count += 1
-            print(f">>> [システム] AIを発注します。(本日 {api_call_count}/{DAILY_API_LIMIT} 回目)")
-
-            prompt = "日本の歴史に関する面白い二択クイズを1問、JSON形式で{\"question\": \"問題文\", \"options\": [\"選択肢A\", \"選択肢B\"], \"answer\": \"正解の選択肢\"} の形式で生成してください。"
-            response = model.start_chat(history=[]).send_message(prompt)
-            raw_text = response.text
+    global QUIZ_KEYS, api_call_count, last_reset_ord, rate_tokens, rate_last_refill
+
+    with _STATE_LOCK:
+        # --- ルール1：1分あたりのリクエスト数制限チェック ---
+        current_time = _now()
+        # 経過時間に応じてトークンを補充（上限はMINUTE_LIMIT）
+        rate_tokens = min(MINUTE_LIMIT, rate_tokens + (current_time - rate_last_refill) * MINUTE_LIMIT / MINUTE_WINDOW)
+        rate_last_refill = current_time
+        if rate_tokens < 1:
+            print(f">>> [レートリミット] 1分あたりのリクエスト上限({MINUTE_LIMIT}回)に達しました。")
+            return json_response({"error": f"Rate limit of {MINUTE_LIMIT} requests per minute exceeded."}), 429
+        rate_tokens -= 1
+
+        # --- ビュッフェのロジック ---
+        today_ord = date.today().toordinal()
+        if today_ord > last_reset_ord:
+            api_call_count = 0
+            last_reset_ord = today_ord
+            print(f">>> [システム] 新しい日です。API発注回数をリセットしました。")
+
+        if len(QUIZ_CACHE) >= SET_SIZE or api_call_count >= DAILY_API_LIMIT:
+            if not QUIZ_CACHE:
+                return json_response({"error": "Daily API limit reached and no quizzes are available."}), 429
+
+            # ビュッフェ台からランダムに1品選ぶ（同じ問題が続けて出ることもある）
+            quiz = QUIZ_CACHE[random.choice(QUIZ_KEYS)]
+            print(f">>> [ビュッフェ提供] ビュッフェ台から1品提供します。(現在 {len(QUIZ_CACHE)}品)")
+            return json_response(quiz)
 
-            json_start = raw_text.find('{')
-            json_end = raw_text.rfind('}') + 1
-
-            if json_start != -1 and json_end != 0:
-                json_string = raw_text[json_start:json_end]
-                new_quiz = json.loads(json_string)
+        print(f">>> [ビュッフェ補充] 品数不足のため、新しいクイズを調理します。")
+        api_call_count += 1
+        print(f">>> [システム] AIを発注します。(本日 {api_call_count}/{DAILY_API_LIMIT} 回目)")
+
+    # AIへの発注（ネットワーク待ち）の間はロックを手放し、他のリクエストを止めない
+    try:
+        response = model.generate_content(_QUIZ_PROMPT, generation_config=QUIZ_GENERATION_CONFIG)
+        new_quiz = orjson.loads(response.text)
+
+        with _STATE_LOCK:
+            question = new_quiz.get('question')
+            if question in QUIZ_CACHE:
+                # AIが同じ問題を返してきた場合は登録しない
+                print(f">>> [システム] 既にビュッフェ台にある問題だったため追加しませんでした。(現在 {len(QUIZ_CACHE)}品)")
             else:
-                raise ValueError("AIの応答から有効なJSONを見つけられませんでした。")
-
-            QUIZ_CACHE.append(new_quiz)
-            print(f">>> [システム] ビュッフェ台に1品追加しました。(現在 {len(QUIZ_CACHE)}品)")
-            return jsonify(new_quiz)
-
-        except Exception as e:
-            print(
-                f"!!!!!! エラー発生 !!!!!!\nエラー内容: {e}\nAIからの生の応答: {response.text if 'response' in locals() else 'N/A'}")
-            return jsonify({"error": str(e)}), 500
-    else:
-        if not QUIZ_CACHE:
-            return jsonify({"error": "Daily API limit reached and no quizzes are available."}), 429
-
-        print(f">>> [コース準備] ビュッフェ台から新しいコースを用意します。")
-        SERVING_POOL = QUIZ_CACHE.copy()
-        random.shuffle(SERVING_POOL)
+                QUIZ_CACHE[question] = new_quiz
+                QUIZ_KEYS = tuple(QUIZ_CACHE)
+                print(f">>> [システム] ビュッフェ台に1品追加しました。(現在 {len(QUIZ_CACHE)}品)")
+        return json_response(new_quiz)
 
-        quiz = SERVING_POOL.pop()
-        print(f">>> [コース提供] 新しいコースの1品目を提供します。")
-        return jsonify(quiz)
+    except Exception as e:
+        print(
+            f"!!!!!! エラー発生 !!!!!!\nエラー内容: {e}\nAIからの生の応答: {response.text if 'response' in locals() else 'N/A'}")
+        return json_response({"error": str(e)}), 500
 
 
-# デバッグモードで開発用サーバーを起動
+# 開発用サーバーを起動（デバッグ・リローダーは無効、リクエストはスレッドで並行処理）
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # 本番ではWSGIサーバー経由で起動する: gunicorn -w 4 -k gthread WebAPI:app
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
@@ -1,15 +1,19 @@
 import os
 import time
-import json
+import orjson
 import random
+import threading
 from datetime import date
 import google.generativeai as genai
-from flask import Flask, jsonify, request
+from flask import Flask, request
 from dotenv import load_dotenv
+from cachetools import LRUCache
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 # --- AWS SDK (boto3) のインポート ---
 import boto3
+from botocore.config import Config
 from mangum import Mangum
 from asgiref.wsgi import WsgiToAsgi
 
@@ -21,8 +25,32 @@ load_dotenv()
 app = Flask(__name__)  # Flaskという基本設計でアプリを作る
 CORS(app)  # 他の場所からの注文を許可する
 
+
+# --- JSONの変換は標準のjsonより高速なorjsonに任せる ---
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = OrjsonProvider(app)  # ルートからdictを返した場合もorjsonで変換される
+
+
+def json_response(data):
+    # jsonifyを経由せず、orjsonで直接レスポンスを組み立てる
+    return app.response_class(orjson.dumps(data), mimetype='application/json')
+
 # --- AWS Systems Manager Parameter Storeの設定 ---
-SSM_CLIENT = boto3.client('ssm', region_name='ap-southeast-2')  # Systems Managerのクライアントを初期化
+# TCPキープアライブでウォームスタート間の接続を使い回し、リトライ回数とタイムアウトを絞って早めに失敗させる
+SSM_CLIENT_CONFIG = Config(
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    connect_timeout=5,
+    read_timeout=10
+)
+SSM_CLIENT = boto3.client('ssm', region_name='ap-southeast-2', config=SSM_CLIENT_CONFIG)  # Systems Managerのクライアントを初期化
 
 # Parameter Storeに保存したGoogle AI Studio APIキーの「名前（パス）」を指定
 # これはLambdaの環境変数で設定することも可能です（推奨）。
@@ -32,33 +60,63 @@ GOOGLE_AI_STUDIO_KEY_PARAM_NAME = os.environ.get(
     "/UnityGame/dev/auth/google_ai_studio_key"  # デフォルト値として指定
 )
 
+# Parameter Storeからまとめて取得するパラメータ名の一覧（増えた場合もここに追加すれば1回の通信で取れる）
+_SSM_PARAM_NAMES = [GOOGLE_AI_STUDIO_KEY_PARAM_NAME]
+
 # Google AI Studio APIキーを保持するグローバル変数
 GOOGLE_AI_STUDIO_API_KEY = None
 
+# Parameter Storeから取得したキーを使い回す時間（秒）。Lambdaのウォームスタート中はSSM/KMSを呼ばない
+API_KEY_TTL_SECONDS = 15 * 60
+# 取得済みのパラメータと取得時刻 (値の辞書, time.monotonic()) 。コンテナごとに取得した時点から数える
+_ssm_cache = None
+# APIキーの再取得とAIモデルの差し替えを同時に1つのスレッドだけが行うためのロック
+_MODEL_LOCK = threading.Lock()
 
-# --- アプリケーション起動前にAPIキーを取得し、AIモデルを設定する ---
-#@app.before_first_request
-def setup_ai_model():
-    global GOOGLE_AI_STUDIO_API_KEY  # グローバル変数を修正することを宣言
-    print(">>> [システム] Parameter StoreからGoogle AI Studio APIキーを取得中...")
+
+def _get_parameters():
+    global _ssm_cache
+    now = time.monotonic()
+    if _ssm_cache is not None and now - _ssm_cache[1] < API_KEY_TTL_SECONDS:
+        return _ssm_cache[0]
     try:
-        # Parameter StoreからAPIキーを取得
+        # Parameter Storeから必要なパラメータを1回のGetParametersでまとめて取得
         # SecureStringなのでWithDecryption=Trueが必要
-        response = SSM_CLIENT.get_parameter(
-            Name=GOOGLE_AI_STUDIO_KEY_PARAM_NAME,
+        response = SSM_CLIENT.get_parameters(
+            Names=_SSM_PARAM_NAMES,
             WithDecryption=True
         )
+        if response['InvalidParameters']:
+            raise KeyError(f"Parameter Storeに存在しないパラメータがあります: {response['InvalidParameters']}")
+    except Exception:
+        if _ssm_cache is not None:
+            # 取得済みの値は残し、次の再取得もTTL後に回す（失敗のたびにSSMへ問い合わせ続けない）
+            _ssm_cache = (_ssm_cache[0], now)
+        raise
+    values = {p['Name']: p['Value'] for p in response['Parameters']}
+    _ssm_cache = (values, now)
+    return values
+
+
+def refresh_ai_model():
+    """TTLが切れていればAPIキーを再取得し、キーが変わっていた場合のみAIモデルを作り直す"""
+    global GOOGLE_AI_STUDIO_API_KEY, model
+    with _MODEL_LOCK:
+        api_key = _get_parameters()[GOOGLE_AI_STUDIO_KEY_PARAM_NAME]
+        if api_key == GOOGLE_AI_STUDIO_API_KEY:
+            return
+        GOOGLE_AI_STUDIO_API_KEY = api_key
+        genai.configure(api_key=GOOGLE_AI_STUDIO_API_KEY)
+        model = genai.GenerativeModel('models/gemini-1.5-flash-latest')
 
-        print(response)
-
-        GOOGLE_AI_STUDIO_API_KEY = response['Parameter']['Value']
-        #print(GOOGLE_AI_STUDIO_API_KEY)
 
+# --- アプリケーション起動前にAPIキーを取得し、AIモデルを設定する ---
+#@app.before_first_request
+def setup_ai_model():
+    print(">>> [システム] Parameter StoreからGoogle AI Studio APIキーを取得中...")
+    try:
         # --- Gemini APIのセットアップ ---
-        genai.configure(api_key=GOOGLE_AI_STUDIO_API_KEY)
-        # モデルのロード
-        global model  # model変数もグローバルとして定義 (あるいはsetup_ai_model内で完結させる)
-        model = genai.GenerativeModel('models/gemini-1.5-flash-latest')
+        refresh_ai_model()
         print(">>> [システム] Google AIモデルのロードに成功しました。")
 
     except Exception as e:
@@ -66,12 +124,13 @@ def setup_ai_model():
         print(f"APIの初期設定に失敗しました。Parameter Storeからのキー取得またはAIモデル設定でエラー。")
         print(f"エラー内容: {e}")
         print(
-            f"1. Lambda実行ロールにParameter Store (ssm:GetParameter) とKMS (kms:Decrypt) の権限があるか確認してください。")
+            f"1. Lambda実行ロールにParameter Store (ssm:GetParameters) とKMS (kms:Decrypt) の権限があるか確認してください。")
         print(f"2. Parameter Storeのパラメータ名 ({GOOGLE_AI_STUDIO_KEY_PARAM_NAME}) が正しいか確認してください。")
         print(f"3. Parameter StoreにAPIキーがSecureStringで正しく保存されているか確認してください。")
         exit()  # サーバーを停止 (Lambdaでは関数の実行が終了する)
 
 # Flaskのルート定義の前に、トップレベルで初期化関数を呼び出す
+# モジュール読み込み時（コンテナ起動時）に1回だけ実行され、ウォームスタートでは再利用される
 setup_ai_model()
 print("setup関数に入りました")
 # 1. まず、Flaskアプリ(WSGI)をASGI互換のアプリに変換する
@@ -84,17 +143,55 @@ handler = Mangum(asgi_app,lifespan="off")
 # レートリミット設定
 MINUTE_LIMIT = 55
 MINUTE_WINDOW = 60
-request_timestamps = []
+_now = time.monotonic  # 時刻合わせの影響を受けない単調増加クロック（属性参照も省く）
+# トークンバケット方式：残りトークン数と最終補充時刻の2つだけを保持する
+rate_tokens = float(MINUTE_LIMIT)
+rate_last_refill = _now()
 
 # API呼び出し上限設定
 DAILY_API_LIMIT = 500
 api_call_count = 0
-last_reset_date = date.today()
+last_reset_ord = date.today().toordinal()  # 比較を整数で済ませるため日付は序数で持つ
 
 # キャッシュとセットの設定
-QUIZ_CACHE = []
-SERVING_POOL = []
 SET_SIZE = 5
+# {問題文: クイズ}。同じ問題の重複登録を防ぐ
+# 補充はSET_SIZE品までだが、AIへの発注が同時に複数走ると超えることがあるため、上限を超えた分は最も長く使われていないものから捨てる
+QUIZ_CACHE = LRUCache(maxsize=SET_SIZE)
+QUIZ_KEYS = ()  # 提供時にランダムに選ぶための問題文の一覧。登録時にだけ作り直す
+
+# 上記のグローバル変数（レートリミット・発注回数・キャッシュ）をまとめて守るロック
+_STATE_LOCK = threading.Lock()
+
+# AIへの注文文（リクエストごとに作り直さないよう、モジュール読み込み時に1回だけ用意する）
+_QUIZ_PROMPT = """
+日本の歴史に関する面白い二択クイズを1問、JSON形式で生成してください。
+以下のフォーマット厳守で、各選択肢の根拠も追加してください。
+
+{
+  "question": "問題文",
+  "options": ["選択肢A", "選択肢B"],
+  "answer": "正解の選択肢 (例: 選択肢A または 選択肢B)",
+  "explanation_A": "選択肢Aに関する簡潔な説明や、それが正解または不正解である根拠。",
+  "explanation_B": "選択肢Bに関する簡潔な説明や、それが正解または不正解である根拠。"
+}
+"""
+
+# AIにはJSONだけを返させる（応答から"{"〜"}"を探す必要がなくなる）
+QUIZ_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "OBJECT",
+        "properties": {
+            "question": {"type": "STRING"},
+            "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "answer": {"type": "STRING"},
+            "explanation_A": {"type": "STRING"},
+            "explanation_B": {"type": "STRING"},
+        },
+        "required": ["question", "options", "answer", "explanation_A", "explanation_B"],
+    },
+}
 
 
 # --- 「/quiz」という注文が来た時の対応マニュアル ---
@@ -103,89 +200,74 @@ def generate_quiz():
     print(f"★★★ 404 DEBUG ★★★ Request path received: {request.path}")
     print(f"★DEBUG★ Received request path: {request.path}")
     print(f"★DEBUG★ Full request headers: {request.headers}")
-    global QUIZ_CACHE, SERVING_POOL, api_call_count, last_reset_date, request_timestamps
+    global QUIZ_KEYS, api_call_count, last_reset_ord, rate_tokens, rate_last_refill
 
     # モデルがロードされているか確認
     if GOOGLE_AI_STUDIO_API_KEY is None:
         print("!!!!!! エラー !!!!!! Google AI Studio API Keyがロードされていません。")
-        return jsonify({"error": "Backend not fully initialized. API key missing."}), 500
+        return json_response({"error": "Backend not fully initialized. API key missing."}), 500
     # ここで model も None ではないことを確認するロジックを追加しても良い
 
-    # --- ルール1：1分あたりのリクエスト数制限チェック ---
-    current_time = time.time()
-    request_timestamps = [t for t in request_timestamps if current_time - t < MINUTE_WINDOW]
-    if len(request_timestamps) >= MINUTE_LIMIT:
-        print(f">>> [レートリミット] 1分あたりのリクエスト上限({MINUTE_LIMIT}回)に達しました。")
-        return jsonify({"error": f"Rate limit of {MINUTE_LIMIT} requests per minute exceeded."}), 429
-    request_timestamps.append(current_time)
-
-    # --- コース料理とビュッフェのロジック ---
-    if SERVING_POOL:
-        print(f">>> [コース提供] 配膳トレイから提供します。(残り {len(SERVING_POOL) - 1} 品)")
-        quiz = SERVING_POOL.pop()
-        return jsonify(quiz)
-
-    print("--- 配膳トレイが空です。次の準備をします。 ---")
-
-    today = date.today()
-    if today > last_reset_date:
-        api_call_count = 0
-        last_reset_date = today
-        print(f">>> [システム] 新しい日です。API発注回数をリセットしました。")
-
-    if len(QUIZ_CACHE) < SET_SIZE and api_call_count < DAILY_API_LIMIT:
+    # TTLが切れていればAPIキーを再取得する（発注回数を数える前に行う）
+    try:
+        refresh_ai_model()
+    except Exception as e:
+        # 一時的なSSM/KMSの失敗では止めず、手元の有効なキーでそのまま続行する
+        print(f"!!!!!! 警告 !!!!!! APIキーの再取得に失敗したため、現在のキーを使い続けます。エラー内容: {e}")
+
+    with _STATE_LOCK:
+        # --- ルール1：1分あたりのリクエスト数制限チェック ---
+        current_time = _now()
+        # 経過時間に応じてトークンを補充（上限はMINUTE_LIMIT）
+        rate_tokens = min(MINUTE_LIMIT, rate_tokens + (current_time - rate_last_refill) * MINUTE_LIMIT / MINUTE_WINDOW)
+        rate_last_refill = current_time
+        if rate_tokens < 1:
+            print(f">>> [レートリミット] 1分あたりのリクエスト上限({MINUTE_LIMIT}回)に達しました。")
+            return json_response({"error": f"Rate limit of {MINUTE_LIMIT} requests per minute exceeded."}), 429
+        rate_tokens -= 1
+
+        # --- ビュッフェのロジック ---
+        today_ord = date.today().toordinal()
+        if today_ord > last_reset_ord:
+            api_call_count = 0
+            last_reset_ord = today_ord
+            print(f">>> [システム] 新しい日です。API発注回数をリセットしました。")
+
+        if len(QUIZ_CACHE) >= SET_SIZE or api_call_count >= DAILY_API_LIMIT:
+            if not QUIZ_CACHE:
+                return json_response({"error": "Daily API limit reached and no quizzes are available."}), 429
+
+            # ビュッフェ台からランダムに1品選ぶ（同じ問題が続けて出ることもある）
+            quiz = QUIZ_CACHE[random.choice(QUIZ_KEYS)]
+            print(f">>> [ビュッフェ提供] ビュッフェ台から1品提供します。(現在 {len(QUIZ_CACHE)}品)")
+            return json_response(quiz)
+
         print(f">>> [ビュッフェ補充] 品数不足のため、新しいクイズを調理します。")
-        try:
-            api_call_count += 1
-            print(f">>> [システム] AIを発注します。(本日 {api_call_count}/{DAILY_API_LIMIT} 回目)")
-
-            prompt = """
-                        日本の歴史に関する面白い二択クイズを1問、JSON形式で生成してください。
-                        以下のフォーマット厳守で、各選択肢の根拠も追加してください。
-
-                        {
-                          "question": "問題文",
-                          "options": ["選択肢A", "選択肢B"],
-                          "answer": "正解の選択肢 (例: 選択肢A または 選択肢B)",
-                          "explanation_A": "選択肢Aに関する簡潔な説明や、それが正解または不正解である根拠。",
-                          "explanation_B": "選択肢Bに関する簡潔な説明や、それが正解または不正解である根拠。"
-                        }
-                        """
-            response = model.start_chat(history=[]).send_message(prompt)  # modelは既にsetup_ai_modelで設定済み
-            #print(response.text)
-
-            #raw_text = response.text.decode('utf-16-be').encode('utf-8')
-            raw_text = response.text
-
-
-            json_start = raw_text.find('{')
-            json_end = raw_text.rfind('}') + 1
-
-            if json_start != -1 and json_end != 0:
-                json_string = raw_text[json_start:json_end]
-                new_quiz = json.loads(json_string)
-            else:
-                raise ValueError("AIの応答から有効なJSONを見つけられませんでした。")
+        api_call_count += 1
+        print(f">>> [システム] AIを発注します。(本日 {api_call_count}/{DAILY_API_LIMIT} 回目)")
 
-            QUIZ_CACHE.append(new_quiz)
-            print(f">>> [システム] ビュッフェ台に1品追加しました。(現在 {len(QUIZ_CACHE)}品)")
-            return jsonify(new_quiz)
+    # AIへの発注（ネットワーク待ち）の間はロックを手放し、他のリクエストを止めない
+    try:
+        response = model.generate_content(_QUIZ_PROMPT, generation_config=QUIZ_GENERATION_CONFIG)  # modelはrefresh_ai_modelで設定済み
+        #print(response.text)
 
-        except Exception as e:
-            print(
-                f"!!!!!! エラー発生 !!!!!!\nエラー内容: {e}\nAIからの生の応答: {response.text if 'response' in locals() else 'N/A'}")
-            return jsonify({"error": str(e)}), 500
-    else:
-        if not QUIZ_CACHE:
-            return jsonify({"error": "Daily API limit reached and no quizzes are available."}), 429
+        new_quiz = orjson.loads(response.text)
 
-        print(f">>> [コース準備] ビュッフェ台から新しいコースを用意します。")
-        SERVING_POOL = QUIZ_CACHE.copy()
-        random.shuffle(SERVING_POOL)
+        with _STATE_LOCK:
+            question = new_quiz.get('question')
+            if question in QUIZ_CACHE:
+                # AIが同じ問題を返してきた場合は登録しない
+                print(f">>> [システム] 既にビュッフェ台にある問題だったため追加しませんでした。(現在 {len(QUIZ_CACHE)}品)")
+            else:
+                QUIZ_CACHE[question] = new_quiz
+                QUIZ_KEYS = tuple(QUIZ_CACHE)
+                print(f">>> [システム] ビュッフェ台に1品追加しました。(現在 {len(QUIZ_CACHE)}品)")
+        return json_response(new_quiz)
 
-        quiz = SERVING_POOL.pop()
-        print(f">>> [コース提供] 新しいコースの1品目を提供します。")
-        return jsonify(quiz)
+    except Exception as e:
+        print(
+            f"!!!!!! エラー発生 !!!!!!\nエラー内容: {e}\nAIからの生の応答: {response.text if 'response' in locals() else 'N/A'}")
+        return json_response({"error": str(e)}), 500
 
 
 @app.route('/default/MyQuizBackendFunction-Container/verify-deployment-v3')
@@ -207,12 +289,14 @@ def simple_test_route():
 
 
 
-# デバッグモードで開発用サーバーを起動
+# 開発用サーバーを起動（デバッグ・リローダーは無効、リクエストはスレッドで並行処理）
+# Lambda上ではMangum経由のhandlerが使われるため、ここは実行されない
 if __name__ == '__main__':
     # ローカルでテストする場合、Parameter Storeのキーを読み取るにはAWS認証情報が必要です
     # 例: ~/.aws/credentials ファイルの設定や、環境変数 AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY など
+    # 本番相当で動かす場合はWSGIサーバーを使う: gunicorn -w 4 -k gthread WebAPIboto3:app
 
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
 
 # ... (Flaskアプリケーションのコード全体) ...
 """